@@ -1,21 +1,45 @@
-from enum import Enum
+from enum import IntEnum
 from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_EXCEPTION, wait as wait_futures
 import requests, psutil
 import subprocess
 import time, threading
 import os
+import queue
+import tempfile
 import logging
 
 # Define timeouts and polling time
 MAX_UPGRADE_TIME = 10 * 60  # [s]
 MAX_DOWNLOAD_TIME = 5 * 60  # [s]
 MAX_WAIT_FOR_IDLE_TIME = 10 * 60  # [s]
-POLLING_TIME = 0.1  # [s]
+POLLING_TIME = 1  # [s]
+MAX_POLLING_TIME = 2  # [s]
+MAX_CONNECTION_CHECK_FAILURES = 3
+CONNECTION_CHECK_TIMEOUT = (1, 1)  # [s] (connect, read)
+BATTERY_CACHE_TIME = 2  # [s]
 
-# Define Download URL
+# Define Download URL, the directory the image is stored in and how it is split into parallel range requests
 DOWNLOAD_URL = "https://raw.githubusercontent.com/MattiaHaas/sevensense/refs/heads/main/images/install.sh"
+IMAGE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_CHUNK_SIZE = 10 * 1024 * 1024  # [bytes]
+DOWNLOAD_BUFFER_SIZE = 64 * 1024  # [bytes]
 INTERNET_CONNECTION_CHECK_URL = "https://www.google.com"
 
+# Get initial software version and device type from environmental variables
+try:
+    INITIAL_VERSION = int(os.environ["INITIAL_VERSION"])
+    DUT = os.environ["DUT"]
+except KeyError as e:
+    raise RuntimeError(f"{e.args[0]} environment variable required") from None
+except ValueError:
+    raise RuntimeError("INITIAL_VERSION environment variable must be an integer") from None
+
+# Share one HTTP session so connection checks and downloads reuse keep-alive connections
+_session = requests.Session()
+_session.headers["User-Agent"] = "sevensense-device"
+
 # Set up the logger
 logger = logging.getLogger("DeviceLogger")
 logger.setLevel(logging.DEBUG)
@@ -29,7 +53,19 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-class DeviceState(Enum):
+# Cache of the last battery reading as (monotonic timestamp, battery)
+_battery_cache = (0.0, None)
+
+
+def _clear_battery_cache():
+    """
+    Clears the cached battery reading so the next power status check reads it again.
+    """
+    global _battery_cache
+    _battery_cache = (0.0, None)
+
+
+class DeviceState(IntEnum):
     """
     Enum representing the possible states of a device during its lifecycle.
     """
@@ -41,7 +77,7 @@ class DeviceState(Enum):
     Downgrading = 4
 
 
-class UpgradeStatus(Enum):
+class UpgradeStatus(IntEnum):
     """
     Enum representing the possible outcomes of a device's upgrade attempt.
     """
@@ -60,14 +96,73 @@ class Device:
         """
         Initializes the device with software version, type, last upgrade status, and state.
         """
-        # Get current software version and type from environmental variables
-        self.software_version = int(os.environ.get("INITIAL_VERSION"))
-        self.device_type = os.environ.get("DUT")
+        # Get current software version and type read from environmental variables
+        self.software_version = INITIAL_VERSION
+        self.device_type = DUT
+
+        # Path of the downloaded image, only set while an update is running
+        self.image_file = None
+
+        # Condition variable notified whenever the device state or upgrade status changes
+        self._state_cv = threading.Condition()
+
+        # Queue of initiated updates processed one at a time by a single persistent worker thread
+        self._update_queue = queue.Queue()
+        self._update_worker = None
+        self._update_future = None
+
+        # Event set to abort the running update and the installation process it is running
+        self._cancel = threading.Event()
+        self._active_process = None
 
         # Initialize the member variables
         self.last_upgrade_status = UpgradeStatus.No_Update
         self.state = DeviceState.Idle
 
+    @property
+    def state(self) -> DeviceState:
+        """
+        Returns the current state of the device.
+
+        Returns:
+            DeviceState: The current state of the device.
+        """
+        return self._state
+
+    @state.setter
+    def state(self, new_state: DeviceState):
+        """
+        Sets the state of the device and wakes up any thread waiting for a state change.
+
+        Args:
+            new_state (DeviceState): The new state of the device.
+        """
+        with self._state_cv:
+            self._state = new_state
+            self._state_cv.notify_all()
+
+    @property
+    def last_upgrade_status(self) -> UpgradeStatus:
+        """
+        Returns the last upgrade result status.
+
+        Returns:
+            UpgradeStatus: The last upgrade status.
+        """
+        return self._last_upgrade_status
+
+    @last_upgrade_status.setter
+    def last_upgrade_status(self, new_status: UpgradeStatus):
+        """
+        Sets the last upgrade status and wakes up any thread waiting for an upgrade result.
+
+        Args:
+            new_status (UpgradeStatus): The new upgrade status.
+        """
+        with self._state_cv:
+            self._last_upgrade_status = new_status
+            self._state_cv.notify_all()
+
     def get_last_upgrade_result(self) -> UpgradeStatus:
         """
         Returns the last upgrade result status.
@@ -97,14 +192,16 @@ class Device:
 
     def get_connection_status(self) -> bool:
         """
-        Checks the internet connection by making a request to a URL.
+        Checks the internet connection by making a HEAD request to a URL, so no response body is downloaded.
 
         Returns:
             bool: True if internet connection is available, False otherwise.
         """
         try:
-            response = requests.get(INTERNET_CONNECTION_CHECK_URL, timeout=5)
-            return response.status_code == 200
+            response = _session.head(
+                INTERNET_CONNECTION_CHECK_URL, timeout=CONNECTION_CHECK_TIMEOUT, allow_redirects=False
+            )
+            return response.ok
         except requests.RequestException:
             return False
 
@@ -115,7 +212,15 @@ class Device:
         Returns:
             bool: True if device is plugged into power, False otherwise.
         """
-        battery = psutil.sensors_battery()
+        global _battery_cache
+
+        # Reuse the last battery reading if it is recent enough
+        now = time.monotonic()
+        timestamp, battery = _battery_cache
+        if battery is None or now - timestamp >= BATTERY_CACHE_TIME:
+            battery = psutil.sensors_battery()
+            _battery_cache = (now, battery)
+
         if battery is not None:
             # Check if the system is plugged into AC power
             return battery.power_plugged
@@ -158,45 +263,183 @@ class Device:
         Returns:
             bool: True if the elapsed time is less than the duration, False otherwise.
         """
-        if start_time - time.time() < duration:
-            return True
-        else:
-            return False
+        return (time.monotonic() - start_time) < duration
 
     def wait(self, target, get_current: Callable, timeout_duration: float) -> bool:
         """
         Waits for a certain condition to be met within the specified timeout.
+        The condition is only re-evaluated when the device state or the last upgrade status changes, so get_current
+        must depend on one of them, otherwise the wait only ends at the timeout.
 
         Args:
             target: The target state or value to wait for.
-            get_current (Callable): A callable function that returns the current state or value.
+            get_current (Callable): A callable function that returns the current state or upgrade status.
             timeout_duration (float): The maximum time to wait before timing out.
 
         Returns:
-            bool: True if the target is reached before the timeout, False otherwise.
+            bool: True if the target is reached before the timeout, False otherwise or if the update was cancelled.
         """
 
-        start_time = time.time()
-        while self.check_time_not_exceeded(start_time, timeout_duration):
-            if target == get_current():
-                return True
-            time.sleep(POLLING_TIME)
-        return False
+        with self._state_cv:
+            # Block until notified of a state change or a cancellation instead of polling
+            reached = self._state_cv.wait_for(
+                lambda: self._cancel.is_set() or target == get_current(), timeout=timeout_duration
+            )
+            return reached and not self._cancel.is_set()
+
+    def wait_for_state(self, target: DeviceState, timeout: float = 5.0) -> bool:
+        """
+        Waits for the device to reach the target state within the specified timeout.
+
+        Args:
+            target (DeviceState): The state to wait for.
+            timeout (float): The maximum time to wait before timing out.
+
+        Returns:
+            bool: True if the target state is reached before the timeout, False otherwise.
+        """
+        return self.wait(target, self.get_current_state, timeout)
+
+    def wait_for_result(self, timeout: float = 5.0) -> bool:
+        """
+        Waits for the last initiated update to finish within the specified timeout.
+
+        Args:
+            timeout (float): The maximum time to wait before timing out.
+
+        Returns:
+            bool: True if the update finished, was cancelled or raised an error before the timeout, False otherwise.
+        """
+        future = self._update_future
+        if future is None:
+            return False
+
+        # Only wait for the future, its result or error is not retrieved so it is never raised here
+        wait_futures([future], timeout=timeout)
+        return future.done()
+
+    def monitor_process(self, process: subprocess.Popen, check: Callable, timeout_duration: float) -> bool:
+        """
+        Blocks until the process exits while a watchdog thread periodically runs the given check.
+        The process is terminated as soon as the check fails or the timeout is exceeded.
+
+        Args:
+            process (subprocess.Popen): The process to monitor.
+            check (Callable): A callable taking the start time and returning False if the process should be aborted.
+            timeout_duration (float): The maximum time to wait for the process to exit.
+
+        Returns:
+            bool: True if the process exited on its own, False if it was terminated.
+        """
+
+        start_time = time.monotonic()
+        finished = threading.Event()
+        aborted = threading.Event()
+
+        def watchdog():
+            while not finished.is_set():
+                if self._cancel.is_set() or not check(start_time):
+                    aborted.set()
+                    process.terminate()
+                    return
+                finished.wait(POLLING_TIME)
+
+        watcher = threading.Thread(target=watchdog, daemon=True)
+        watcher.start()
+
+        try:
+            process.wait(timeout=timeout_duration)
+        except subprocess.TimeoutExpired:
+            logger.error(f"Process timed out after {timeout_duration} seconds.")
+            aborted.set()
+            process.terminate()
+            process.wait()
+        finally:
+            finished.set()
+            watcher.join()
+
+        if self._cancel.is_set():
+            logger.error("Process terminated as the update was cancelled.")
+            return False
+        return not aborted.is_set()
 
     def initiate_update(self, *args, **kwargs):
         """
-        Initiates the update process in a separate thread.
+        Initiates the update process on the update worker thread.
 
         Args:
             *args: Arguments to pass to the update function.
             **kwargs: Keyword arguments to pass to the update function.
+
+        Returns:
+            Future: A future holding the result of the update function.
+        """
+        # Hold the lock so concurrent callers never start a second worker or interleave with cancel_update
+        with self._state_cv:
+            # Start the worker on the first update, it is a daemon so a pending update never blocks the exit
+            if self._update_worker is None:
+                self._update_worker = threading.Thread(target=self.process_updates, daemon=True)
+                self._update_worker.start()
+
+            self._update_future = Future()
+            self._update_queue.put((self._update_future, args, kwargs))
+            return self._update_future
+
+    def process_updates(self):
         """
-        t = threading.Thread(target=self.update, args=args, kwargs=kwargs, daemon=True)
-        t.start()
+        Runs the initiated updates one after another on the update worker thread.
+        """
+        while True:
+            future, args, kwargs = self._update_queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result, exception = self.update(*args, **kwargs), None
+            except Exception as e:
+                result, exception = None, e
+
+            # Clear the cancel event and finish the future atomically, so a racing cancel_update never leaks into
+            # the next update
+            with self._state_cv:
+                self._cancel.clear()
+                if exception is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exception)
+
+    def cancel_update(self) -> bool:
+        """
+        Cancels the last initiated update, terminating the installation process if one is running.
+        A cancelled update does not change the last upgrade status. A download or installation which is running when
+        the update is cancelled returns the device to the idle state, otherwise the state is left unchanged.
+
+        Returns:
+            bool: True if an update was pending or running and got cancelled, False otherwise.
+        """
+        with self._state_cv:
+            future = self._update_future
+            if future is None or future.done():
+                return False
+
+            # An update which did not start yet is simply removed from the queue
+            if future.cancel():
+                logger.info("Pending update cancelled.")
+                return True
+
+            logger.info("Cancelling the running update.")
+            self._cancel.set()
+            self._state_cv.notify_all()
+
+        process = self._active_process
+        if process is not None:
+            process.terminate()
+        return True
 
     def update(self, new_version: int) -> bool:
         """
         Manages the update process: downloading and installing the new version.
+        If the update is cancelled the last upgrade status is left unchanged.
 
         Args:
             new_version (int): The version to upgrade or downgrade to.
@@ -206,6 +449,9 @@ class Device:
         """
 
         transitioned_to_idle = self.wait(DeviceState.Idle, self.get_current_state, MAX_WAIT_FOR_IDLE_TIME)
+        if self._cancel.is_set():
+            logger.info("The update was cancelled.")
+            return False
         if not transitioned_to_idle:
             logger.error("The update could not be performed as the device state is not idle.")
             return False
@@ -215,19 +461,26 @@ class Device:
             logger.info("The current version and the new version are the same.")
             return False
 
-        # Stage 1, download the image from remote
-        download_success = self.download_image(new_version=new_version)
-        if not download_success:
-            self.last_upgrade_status = UpgradeStatus.Failed
-            self.state = DeviceState.Idle
-            return False
+        try:
+            # Stage 1, download the image from remote
+            download_success = self.download_image(new_version=new_version)
+            if not download_success:
+                self.fail_update()
+                return False
 
-        # Stage 2, install the downloaded image if download was successful
-        upgrade_success = self.install_image(new_version=new_version)
-        if not upgrade_success:
-            self.last_upgrade_status = UpgradeStatus.Failed
-            self.state = DeviceState.Idle
-            return False
+            # Stage 2, install the downloaded image if download was successful
+            upgrade_success = self.install_image(new_version=new_version)
+            if not upgrade_success:
+                self.fail_update()
+                return False
+        except Exception:
+            # Never leave the device stuck in the downloading or installing state
+            logger.exception("Unexpected error during the update.")
+            self.fail_update()
+            raise
+        finally:
+            # The image is not needed after the installation, remove it so it does not stay in memory on tmpfs
+            self.remove_image()
 
         # Update the upgrade notification and current software version
         self.last_upgrade_status = UpgradeStatus.Success
@@ -237,6 +490,16 @@ class Device:
         logger.info(f"Software update to version {new_version} complete.")
         return True
 
+    def fail_update(self):
+        """
+        Returns the device to the idle state after a failed update and records the failure unless it was cancelled.
+        """
+        if self._cancel.is_set():
+            logger.info("The update was cancelled.")
+        else:
+            self.last_upgrade_status = UpgradeStatus.Failed
+        self.state = DeviceState.Idle
+
     def download_image(self, new_version: int):
         """
         Downloads the firmware image from a remote server.
@@ -255,36 +518,147 @@ class Device:
         logger.info(f"Starting software version {new_version} download.")
         self.state = DeviceState.Downloading
 
-        # Create process for downloading the image
-        command = ["curl", "-O", DOWNLOAD_URL]
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # Check once that the internet connection is available before starting the download
+        if not self.get_connection_status():
+            logger.error("No internet connection available for the download.")
+            return False
 
-        start_time = time.time()
+        # Store the image in a private file which no other user or download can access
+        try:
+            fd, self.image_file = tempfile.mkstemp(dir=IMAGE_DIR, suffix=".sh")
+        except OSError as e:
+            logger.error(f"Download failed: {e}")
+            return False
 
-        while True:
-            # Check if the internet connection is still active
-            if not self.get_connection_status():
-                logger.error("Internet connection lost during download.")
-                process.terminate()
-                process.wait()
-                return False
+        start_time = time.monotonic()
+        cancel = threading.Event()
 
-            # If the timeout is exceeded, terminate the process
-            if not self.check_download_timeout(start_time):
-                logger.error(f"Download timed out after {MAX_DOWNLOAD_TIME} seconds.")
-                process.terminate()
-                process.wait()
+        try:
+            # Ask for the image size, the body must not be compressed for the ranges to match the file
+            response = _session.head(DOWNLOAD_URL, headers={"Accept-Encoding": "identity"}, timeout=5)
+            response.raise_for_status()
+            size = int(response.headers.get("Content-Length", 0))
+
+            # Split the image into ranges if the server supports range requests, otherwise use a single stream
+            use_range = size > 0 and response.headers.get("Accept-Ranges") == "bytes"
+            if use_range:
+                os.posix_fallocate(fd, 0, size)
+                ranges = [
+                    (start, min(start + DOWNLOAD_CHUNK_SIZE, size) - 1) for start in range(0, size, DOWNLOAD_CHUNK_SIZE)
+                ]
+            else:
+                ranges = [(0, size - 1 if size > 0 else None)]
+
+            executor = ThreadPoolExecutor(max_workers=DOWNLOAD_CONNECTIONS)
+            pending = [
+                executor.submit(self.download_range, self.image_file, start, end, cancel, use_range)
+                for start, end in ranges
+            ]
+            try:
+                connection_failures = 0
+                while pending:
+                    if self._cancel.is_set():
+                        logger.error("Download cancelled.")
+                        return False
+
+                    # Check if the timeout is exceeded
+                    if not self.check_download_timeout(start_time):
+                        logger.error(f"Download timed out after {MAX_DOWNLOAD_TIME} seconds.")
+                        return False
+
+                    # Back off exponentially while the connection checks keep failing
+                    polling_time = min(2**connection_failures * POLLING_TIME, MAX_POLLING_TIME)
+                    done, pending = wait_futures(pending, timeout=polling_time, return_when=FIRST_EXCEPTION)
+                    for future in done:
+                        future.result()
+
+                    if not pending:
+                        break
+
+                    # Check if the internet connection is still active
+                    if self.get_connection_status():
+                        connection_failures = 0
+                    else:
+                        connection_failures += 1
+                        if connection_failures >= MAX_CONNECTION_CHECK_FAILURES:
+                            logger.error("Internet connection lost during download.")
+                            return False
+            finally:
+                # Stop the running range downloads and drop the queued ones, without waiting for the running ones to
+                # notice as they open the image file themselves and stop writing at their next buffer
+                cancel.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+
+            if self._cancel.is_set():
+                logger.error("Download cancelled.")
                 return False
+        except (requests.RequestException, OSError) as e:
+            logger.error(f"Download failed: {e}")
+            return False
+        finally:
+            os.close(fd)
 
-            # Check if the download process is still running
-            if process.poll() is not None:
-                logger.info("Download completed successfully.")
-                break
-
-            # Sleep before checking again
-            time.sleep(POLLING_TIME)
+        logger.info("Download completed successfully.")
         return True
 
+    def download_range(
+        self, image_file: str, start: int, end: int | None, cancel: threading.Event, use_range: bool = True
+    ):
+        """
+        Downloads a byte range of the firmware image and writes it at its offset in the image file.
+
+        Args:
+            image_file (str): The path of the image file.
+            start (int): The first byte of the range.
+            end (int | None): The last byte of the range, or None if the size of the image is unknown.
+            cancel (threading.Event): Event which stops the download when set, as does cancelling the update.
+            use_range (bool): Whether to request the range, or to download the whole image in one request.
+
+        Raises:
+            requests.HTTPError: If the server did not send exactly the requested bytes.
+        """
+        # Skip the request entirely if the download was stopped before this range started
+        if cancel.is_set() or self._cancel.is_set():
+            return
+
+        headers = {"Accept-Encoding": "identity"}
+        if use_range:
+            headers["Range"] = f"bytes={start}-{end}"
+
+        with _session.get(DOWNLOAD_URL, headers=headers, stream=True, timeout=5) as response:
+            response.raise_for_status()
+            content_range = response.headers.get("Content-Range", "").partition("/")[0]
+            if use_range and (response.status_code != 206 or content_range != f"bytes {start}-{end}"):
+                raise requests.HTTPError(f"Range request for bytes {start}-{end} was not honoured.")
+
+            # Open the image file separately so it stays valid if the download gives up on this range
+            fd = os.open(image_file, os.O_WRONLY)
+            try:
+                offset = start
+                for buf in response.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+                    if cancel.is_set() or self._cancel.is_set():
+                        return
+                    offset += os.pwrite(fd, buf, offset)
+            finally:
+                os.close(fd)
+
+        # Make sure no part of the range is left empty or overwritten with more data than requested
+        if end is not None and offset != end + 1:
+            raise requests.HTTPError(f"Received bytes {start}-{offset - 1} instead of {start}-{end}.")
+
+    def remove_image(self):
+        """
+        Removes the downloaded image file if there is one.
+        """
+        if self.image_file is None:
+            return
+
+        try:
+            os.unlink(self.image_file)
+        except FileNotFoundError:
+            pass
+        self.image_file = None
+
     def install_image(self, new_version: int):
         """
         Installs the downloaded firmware image onto the device.
@@ -309,36 +683,43 @@ class Device:
             self.state = DeviceState.Upgrading
 
         # Set up the process for installing the image
-        command = "chmod +x install.sh && ./install.sh"
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-
-        start_time = time.time()
-
-        while True:
+        # Run the image through bash as /dev/shm is commonly mounted noexec
+        # Only pipe the output through Python if it is actually logged
+        command = ["bash", self.image_file]
+        log_output = logger.isEnabledFor(logging.DEBUG)
+        stdout = subprocess.PIPE if log_output else subprocess.DEVNULL
+        process = subprocess.Popen(command, stdout=stdout, stderr=subprocess.DEVNULL)
+        self._active_process = process
+
+        def drain_output(stream):
+            # Print each line from stdout as soon as it is available, only decoding the lines that are logged
+            for line in iter(stream.readline, b""):
+                logger.debug(line.strip().decode("utf-8", "replace"))
+
+        # Stream the output on a separate thread so it never delays the monitoring
+        reader = None
+        if log_output:
+            reader = threading.Thread(target=drain_output, args=(process.stdout,), daemon=True)
+            reader.start()
+
+        def check_install(start_time: float) -> bool:
             # Check if power is still available
             if not self.get_power_status():
                 logger.error("Power loss detected during the upgrade.")
-                process.terminate()
-                process.wait()
                 return False
 
-            # If the timeout is exceeded, terminate the process
+            # Check if the timeout is exceeded
             if not self.check_install_timeout(start_time):
                 logger.error(f"Upgrade timed out after {MAX_UPGRADE_TIME} seconds.")
-                process.terminate()
-                process.wait()
                 return False
+            return True
 
-            output = process.stdout.readline()
-            while output:
-                logger.debug(output.strip())  # Print each line from stdout
-                output = process.stdout.readline()
-
-            # Check if the upgrade process is still running
-            if process.poll() is not None:
-                logger.info("Upgrade completed successfully.")
-                break
+        success = self.monitor_process(process, check_install, MAX_UPGRADE_TIME)
+        self._active_process = None
+        if not success:
+            return False
 
-            # Sleep before checking again
-            time.sleep(POLLING_TIME)
+        if reader is not None:
+            reader.join()
+        logger.info("Upgrade completed successfully.")
         return True
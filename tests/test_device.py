@@ -1,7 +1,50 @@
-from sevensense_device.device import Device, DeviceState, UpgradeStatus
+from sevensense_device.device import Device, DeviceState, UpgradeStatus, _clear_battery_cache
+import pytest
+import signal
 import time
 
 
+@pytest.fixture
+def empty_battery_cache():
+    """
+    Fixture which empties the battery cache before and after a test, so mocked readings never leak into other tests.
+    """
+    _clear_battery_cache()
+    yield
+    _clear_battery_cache()
+
+
+def mock_image_server(mocker, image: bytes, delay: float = 0.0, rate: float = 0.0):
+    """
+    Mocks the remote server to serve the given image in byte ranges, each range request taking the given delay.
+    If a rate is given the ranges are streamed in buffers of the requested size at that rate in bytes per second.
+    """
+
+    def stream(data, chunk_size):
+        for i in range(0, len(data), chunk_size):
+            buf = data[i : i + chunk_size]
+            time.sleep(len(buf) / rate)
+            yield buf
+
+    def get(url, headers, **kwargs):
+        time.sleep(delay)
+        start, end = map(int, headers["Range"].removeprefix("bytes=").split("-"))
+        data = image[start : end + 1]
+        response = mocker.MagicMock()
+        response.__enter__.return_value.status_code = 206
+        response.__enter__.return_value.headers = {"Content-Range": f"bytes {start}-{end}/{len(image)}"}
+        if rate:
+            response.__enter__.return_value.iter_content.side_effect = lambda chunk_size: stream(data, chunk_size)
+        else:
+            response.__enter__.return_value.iter_content.return_value = [data]
+        return response
+
+    session = mocker.patch("sevensense_device.device._session")
+    session.head.return_value.headers = {"Content-Length": str(len(image)), "Accept-Ranges": "bytes"}
+    session.get.side_effect = get
+    return session
+
+
 def test_upgrade_not_allowed_for_same_version():
     """
     Test case to ensure that an upgrade is not allowed if the device is already on the same version.
@@ -31,6 +74,75 @@ def test_upgrade_in_state_positioning():
     assert device.get_current_state() == DeviceState.Positioning, "Upgrade accepted despite DUT being in DUT mode"
 
 
+def test_cancel_update():
+    """
+    Test case to ensure that an update waiting for the 'Idle' state can be cancelled.
+    The update should stop right away and the device should remain in the 'Positioning' state.
+    """
+    # initialize device
+    device = Device()
+
+    # set device state to Positioning
+    device.state = DeviceState.Positioning
+
+    # call update and cancel it
+    device.initiate_update(new_version=4)
+    assert device.cancel_update(), "Update not cancelled despite waiting for the Idle state"
+    assert device.wait_for_result(timeout=1.0), "Update still running despite being cancelled"
+    assert device.get_current_state() == DeviceState.Positioning, "Update started despite being cancelled"
+    assert not device.cancel_update(), "Update cancelled despite no update running"
+
+
+def test_cancel_update_during_install(mocker, tmp_path):
+    """
+    Test case to ensure that an update can be cancelled while the image is being installed.
+    The installation process should be terminated, the device should return to the 'Idle' state and the last upgrade
+    status should remain unchanged.
+    """
+    # mock a remote server serving an image which installs until it is terminated
+    mock_image_server(mocker, b"exec sleep 30\n")
+    mocker.patch.object(Device, "get_connection_status", return_value=True)
+    mocker.patch.object(Device, "get_power_status", return_value=True)
+    mocker.patch("sevensense_device.device.IMAGE_DIR", str(tmp_path))
+    monitor_spy = mocker.spy(Device, "monitor_process")
+
+    # initialize device, call update and cancel it once the installation started
+    device = Device()
+    device.initiate_update(new_version=3)
+    assert device.wait_for_state(DeviceState.Upgrading, timeout=5.0), "Installation not started"
+    assert device.cancel_update(), "Update not cancelled despite installing"
+    assert device.wait_for_result(timeout=5.0), "Update still running despite being cancelled"
+
+    process = monitor_spy.call_args.args[1]
+    assert process.returncode == -signal.SIGTERM, "Installation process not terminated despite cancelled update"
+    assert monitor_spy.spy_return is False, "Installation successful despite cancelled update"
+    assert device.get_current_state() == DeviceState.Idle, "Device not idle after cancelled update"
+    assert device.get_last_upgrade_result() == UpgradeStatus.No_Update, "Upgrade status changed by cancelled update"
+
+
+def test_cancel_update_during_download(mocker, tmp_path):
+    """
+    Test case to ensure that an update can be cancelled promptly while a slow byte range is being downloaded.
+    The update should finish shortly after the cancellation instead of after the range download completes.
+    """
+    # mock a slow remote server which takes 10 seconds to send the image
+    mock_image_server(mocker, b"x" * 2 * 1024 * 1024, rate=200 * 1024)
+    mocker.patch.object(Device, "get_connection_status", return_value=True)
+    mocker.patch("sevensense_device.device.IMAGE_DIR", str(tmp_path))
+
+    # initialize device, call update and cancel it once the download started
+    device = Device()
+    device.initiate_update(new_version=3)
+    assert device.wait_for_state(DeviceState.Downloading, timeout=5.0), "Download not started"
+    time.sleep(0.2)
+
+    start_time = time.monotonic()
+    assert device.cancel_update(), "Update not cancelled despite downloading"
+    assert device.wait_for_result(timeout=1.0), "Update still running despite being cancelled"
+    assert time.monotonic() - start_time < 1.0, "Update not stopped promptly after being cancelled"
+    assert device.get_current_state() == DeviceState.Idle, "Device not idle after cancelled update"
+
+
 def test_upgrade_switching_state_to_idle():
     """
     Test case to ensure that the upgrade is allowed when the device switches from the 'Positioning' state to the 'Idle' state.
@@ -46,11 +158,14 @@ def test_upgrade_switching_state_to_idle():
 
     # switch device state to Idle and make sure update starts
     device.state = DeviceState.Idle
-    time.sleep(0.2)
-    assert (
-        device.get_current_state() != DeviceState.Idle
+    assert device.wait_for_state(
+        DeviceState.Downloading, timeout=1.0
     ), "Upgrade not accepted despite DUT switching from Positioning to Idle mode"
 
+    # stop the update so it does not keep running during the other tests
+    device.cancel_update()
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
+
 
 def test_downgrade():
     """
@@ -61,11 +176,14 @@ def test_downgrade():
     device.initiate_update(new_version=1)
 
     # make sure downgrade update starts
-    time.sleep(0.1)
-    assert (
-        device.get_current_state() != DeviceState.Idle
+    assert device.wait_for_state(
+        DeviceState.Downloading, timeout=1.0
     ), "Upgrade not accepted despite DUT switching from Positioning to Idle mode"
 
+    # stop the update so it does not keep running during the other tests
+    device.cancel_update()
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
+
 
 def test_done_notification():
     """
@@ -79,9 +197,7 @@ def test_done_notification():
     device.initiate_update(new_version=new_version)
 
     # wait for result
-    time.sleep(0.1)
-    while device.get_current_state() != DeviceState.Idle:
-        time.sleep(0.1)
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
 
     if device.get_current_version() == new_version:
         assert (
@@ -106,11 +222,25 @@ def test_power_interruption(mocker):
     device.initiate_update(new_version=3)
 
     # wait for result
-    while device.get_last_upgrade_result() == UpgradeStatus.No_Update:
-        time.sleep(0.1)
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
     assert device.get_last_upgrade_result() == UpgradeStatus.Failed, "Upgrade successful despite power loss"
 
 
+def test_power_status_cached(mocker, empty_battery_cache):
+    """
+    Test case to ensure that the battery status is read only once within the cache time.
+    Consecutive power status checks should reuse the cached battery reading.
+    """
+    # mock the battery reading
+    mock_battery = mocker.patch("psutil.sensors_battery", return_value=mocker.Mock(power_plugged=True))
+
+    # initialize device and check the power status twice
+    device = Device()
+    assert device.get_power_status(), "Power status not plugged despite plugged battery"
+    assert device.get_power_status(), "Power status not plugged despite plugged battery"
+    assert mock_battery.call_count == 1, "Battery status read again within the cache time"
+
+
 def test_connection_interruption(mocker):
     """
     Test case to simulate a connection interruption during the upgrade process.
@@ -124,12 +254,124 @@ def test_connection_interruption(mocker):
     device.initiate_update(new_version=3)
 
     # wait for result
-    while device.get_last_upgrade_result() == UpgradeStatus.No_Update:
-        time.sleep(0.1)
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
     assert device.get_last_upgrade_result() == UpgradeStatus.Failed, "Upgrade successful despite connection loss"
 
 
-def test_download_timeout(mocker):
+def test_range_download(mocker, tmp_path):
+    """
+    Test case to ensure that the image is downloaded in byte ranges and reassembled in order.
+    The downloaded file should match the image served by the remote server.
+    """
+    image = b"#!/bin/sh\necho 'Installation complete!'\n"
+
+    # mock the remote server and download into a temporary directory
+    session = mock_image_server(mocker, image)
+    mocker.patch("sevensense_device.device.DOWNLOAD_CHUNK_SIZE", 8)
+    mocker.patch.object(Device, "get_connection_status", return_value=True)
+    mocker.patch("sevensense_device.device.IMAGE_DIR", str(tmp_path))
+
+    # initialize device and download the image
+    device = Device()
+    assert device.download_image(new_version=3), "Download failed despite available image"
+    assert session.get.call_count == 5, "Image not downloaded in byte ranges"
+    with open(device.image_file, "rb") as f:
+        assert f.read() == image, "Downloaded image differs from remote image"
+
+
+def test_range_download_incomplete(mocker, tmp_path):
+    """
+    Test case to ensure that a byte range with missing data fails the download.
+    The download should fail instead of leaving part of the image empty.
+    """
+    image = b"#!/bin/sh\necho 'Installation complete!'\n"
+
+    # mock a remote server which only sends the first half of every range
+    session = mock_image_server(mocker, image)
+    serve_range = session.get.side_effect
+
+    def get_truncated(url, headers, **kwargs):
+        response = serve_range(url, headers, **kwargs)
+        data = response.__enter__.return_value.iter_content.return_value[0]
+        response.__enter__.return_value.iter_content.return_value = [data[: len(data) // 2]]
+        return response
+
+    session.get.side_effect = get_truncated
+    mocker.patch("sevensense_device.device.DOWNLOAD_CHUNK_SIZE", 8)
+    mocker.patch.object(Device, "get_connection_status", return_value=True)
+    mocker.patch("sevensense_device.device.IMAGE_DIR", str(tmp_path))
+
+    # initialize device and download the image
+    device = Device()
+    assert not device.download_image(new_version=3), "Download successful despite incomplete byte ranges"
+
+
+def test_image_file_not_created(mocker, tmp_path):
+    """
+    Test case to ensure that a failure to create the image file fails the update.
+    The device should return to the 'Idle' state and notify about the failure.
+    """
+    # mock an available connection and a missing image directory
+    mocker.patch.object(Device, "get_connection_status", return_value=True)
+    mocker.patch("sevensense_device.device.IMAGE_DIR", str(tmp_path / "missing"))
+
+    # initialize device and call update
+    device = Device()
+    assert not device.update(new_version=3), "Upgrade successful despite missing image directory"
+    assert device.get_current_state() == DeviceState.Idle, "Device not idle after failed update"
+    assert device.get_last_upgrade_result() == UpgradeStatus.Failed, "Upgrade failure not notified"
+
+
+def test_unexpected_update_error(mocker):
+    """
+    Test case to ensure that an unexpected error during the update does not leave the device in an update state.
+    The error should be raised, the device should return to the 'Idle' state and notify about the failure.
+    """
+    # mock a successful download and an installation raising an unexpected error
+    mocker.patch.object(Device, "download_image", return_value=True)
+    mocker.patch.object(Device, "install_image", side_effect=RuntimeError("unexpected"))
+
+    # initialize device and call update
+    device = Device()
+    with pytest.raises(RuntimeError):
+        device.update(new_version=3)
+    assert device.get_current_state() == DeviceState.Idle, "Device not idle after failed update"
+    assert device.get_last_upgrade_result() == UpgradeStatus.Failed, "Upgrade failure not notified"
+
+
+def test_wait_for_result_after_error(mocker):
+    """
+    Test case to ensure that waiting for the result of an update which raised an error does not raise it again.
+    """
+    # mock an update raising an unexpected error
+    mocker.patch.object(Device, "update", side_effect=RuntimeError("unexpected"))
+
+    # initialize device and call update
+    device = Device()
+    device.initiate_update(new_version=3)
+    assert device.wait_for_result(timeout=5.0), "Update did not finish in time"
+
+
+def test_download_stopped_on_connection_loss(mocker, tmp_path):
+    """
+    Test case to ensure that the remaining byte ranges are not requested once the connection is lost.
+    The download should fail without requesting the queued ranges.
+    """
+    # mock a slow remote server and a connection which is lost after the download started
+    session = mock_image_server(mocker, b"x" * 40, delay=0.2)
+    mocker.patch("sevensense_device.device.DOWNLOAD_CHUNK_SIZE", 1)
+    mocker.patch("sevensense_device.device.POLLING_TIME", 0.05)
+    mocker.patch("sevensense_device.device.MAX_CONNECTION_CHECK_FAILURES", 1)
+    mocker.patch.object(Device, "get_connection_status", side_effect=[True, False])
+    mocker.patch("sevensense_device.device.IMAGE_DIR", str(tmp_path))
+
+    # initialize device and download the image
+    device = Device()
+    assert not device.download_image(new_version=3), "Download successful despite connection loss"
+    assert session.get.call_count < 40, "Queued byte ranges requested despite connection loss"
+
+
+def test_download_timeout(mocker, tmp_path):
     """
     Test case to simulate a download timeout during the firmware download process.
     The upgrade should fail if the download exceeds the maximum allowed time.
@@ -137,13 +379,20 @@ def test_download_timeout(mocker):
     # mock call from download timeout to fail the update
     mock_method = mocker.patch.object(Device, "check_download_timeout", return_value=False)
 
+    # mock an available remote server so only the timeout can fail the download
+    mock_image_server(mocker, b"#!/bin/sh\n")
+    mocker.patch.object(Device, "get_connection_status", return_value=True)
+    mocker.patch("sevensense_device.device.IMAGE_DIR", str(tmp_path))
+    mock_install = mocker.patch.object(Device, "install_image", return_value=True)
+
     # initialize device and call update
     device = Device()
     device.initiate_update(new_version=3)
 
     # wait for result
-    while device.get_last_upgrade_result() == UpgradeStatus.No_Update:
-        time.sleep(0.1)
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
+    mock_install.assert_not_called()
+    assert not list(tmp_path.iterdir()), "Image not removed after the failed download"
     assert device.get_last_upgrade_result() == UpgradeStatus.Failed, "Upgrade successful despite download timeout"
 
 
@@ -160,11 +409,23 @@ def test_install_timeout(mocker):
     device.initiate_update(new_version=3)
 
     # wait for result
-    while device.get_last_upgrade_result() == UpgradeStatus.No_Update:
-        time.sleep(0.1)
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
     assert device.get_last_upgrade_result() == UpgradeStatus.Failed, "Upgrade successful despite install timeout"
 
 
+def test_time_exceeded(mocker):
+    """
+    Test case to ensure that the elapsed time check reports an exceeded duration.
+    The check should pass before the duration has elapsed and fail once the clock advances past it.
+    """
+    # initialize device and mock the monotonic clock
+    device = Device()
+    mocker.patch("sevensense_device.device.time.monotonic", return_value=100.0)
+
+    assert device.check_time_not_exceeded(start_time=95.0, duration=10.0), "Time exceeded before duration elapsed"
+    assert not device.check_time_not_exceeded(start_time=85.0, duration=10.0), "Time not exceeded after duration"
+
+
 def test_connection_interruption_recovery(mocker):
     """
     Test case to simulate recovery from a connection interruption during the upgrade.
@@ -181,8 +442,7 @@ def test_connection_interruption_recovery(mocker):
     device.initiate_update(new_version=3)
 
     # wait for result
-    while device.get_last_upgrade_result() == UpgradeStatus.No_Update:
-        time.sleep(0.1)
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
 
     # stop mocking the connection status call
     mocker.stop(mock_method_connection)
@@ -191,9 +451,7 @@ def test_connection_interruption_recovery(mocker):
     device.initiate_update(new_version=3)
 
     # wait for result
-    time.sleep(0.1)
-    while device.get_current_state() != DeviceState.Idle:
-        time.sleep(0.1)
+    assert device.wait_for_result(timeout=60.0), "Update did not finish in time"
 
     assert (
         device.get_last_upgrade_result() == UpgradeStatus.Success